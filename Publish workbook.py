@@ -12,26 +12,65 @@
 
 from version import VERSION
 import requests 
-import xml.etree.ElementTree as ET 
 import sys
 import os
-import math
+import stat
 import getpass
+import uuid
+import functools
+import hashlib
+import base64
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from xml.sax.saxutils import quoteattr
 
 
-from requests.packages.urllib3.fields import RequestField
-from requests.packages.urllib3.filepost import encode_multipart_formdata
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+try:
+    from lxml import etree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
 
 xmlns = {'t': 'http://tableau.com/api'}
 
 
-FILESIZE_LIMIT = 1024 * 1024 * 64   # 64MB
+def _compile_find(path):
+    
+    # lxml compiles the expression and resolves the namespace prefix once;
+    # ElementTree falls back to a plain find() on every call.
+    if hasattr(ET, 'XPath'):
+        xpath = ET.XPath(path, namespaces=xmlns)
+        return lambda element: next(iter(xpath(element)), None)
+    return lambda element: element.find(path, namespaces=xmlns)
 
 
-CHUNK_SIZE = 1024 * 1024 * 5    # 5MB
+_find_error = _compile_find('t:error')
+_find_summary = _compile_find('.//t:summary')
+_find_detail = _compile_find('.//t:detail')
+_find_credentials = _compile_find('t:credentials')
+_find_site = _compile_find('.//t:site')
+_find_file_upload = _compile_find('t:fileUpload')
+_find_project = _compile_find('.//t:project')
+
 
 if sys.version[0] == '3': raw_input=input
 
+# One session for every call so chunk PUTs reuse the same keep-alive connection
+# instead of paying a TCP + TLS handshake each.
+SESSION = requests.Session()
+
+# Throttling and transient server errors are retried with exponential backoff
+# so a single 503 does not throw away the chunks already uploaded. Once the
+# retries run out the last response is returned for _check_status to report.
+_retries = Retry(total=5, backoff_factor=1.0, status_forcelist=[429, 500, 502, 503, 504],
+                 allowed_methods=['HEAD', 'GET', 'POST', 'PUT'], respect_retry_after_header=True,
+                 raise_on_status=False)
+_adapter = HTTPAdapter(pool_connections=16, pool_maxsize=16, max_retries=_retries)
+SESSION.mount('http://', _adapter)
+SESSION.mount('https://', _adapter)
+
 
 class ApiCallError(Exception):
     pass
@@ -41,41 +80,182 @@ class UserDefinedFieldError(Exception):
     pass
 
 
-def _encode_for_display(text):
-   
-    return text.encode('ascii', errors="backslashreplace").decode('utf-8')
+def _positive_int_from_env(name, default, maximum=None):
+    
+    value = os.environ.get(name, str(default))
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        error = "{0} must be a positive integer, got '{1}'".format(name, value)
+        raise UserDefinedFieldError(error)
+    if maximum is not None and number > maximum:
+        error = "{0} must be at most {1}, got '{2}'".format(name, maximum, value)
+        raise UserDefinedFieldError(error)
+    return number
+
+
+# Largest request body the server accepts, for a single publish request and
+# for each chunk PUT alike.
+FILESIZE_LIMIT = 1024 * 1024 * 64   # 64MB
+
 
+# Each chunk PUT costs a round trip regardless of its size, so larger chunks
+# mean fewer round trips, up to the server's FILESIZE_LIMIT.
+CHUNK_SIZE = _positive_int_from_env('TABLEAU_UPLOAD_CHUNK_SIZE', 1024 * 1024 * 16, FILESIZE_LIMIT)    # 16MB
 
-def _make_multipart(parts):
+# Number of chunks read from disk ahead of the upload. PUTs are still sent one
+# at a time, in file order, since Tableau appends each chunk at the session's
+# current offset. Up to CHUNK_SIZE * UPLOAD_READ_AHEAD_CHUNKS bytes are held at
+# once; beyond a couple of chunks the read-ahead buys nothing, so the depth is
+# capped to stay within READ_AHEAD_MEMORY_LIMIT, but never below one chunk.
+READ_AHEAD_MEMORY_LIMIT = 1024 * 1024 * 64    # 64MB
+UPLOAD_READ_AHEAD_CHUNKS = max(1, min(_positive_int_from_env('TABLEAU_UPLOAD_READ_AHEAD', 2),
+                                      READ_AHEAD_MEMORY_LIMIT // CHUNK_SIZE))
+
+
+def _multipart_part_header(boundary, name, filename, content_type):
     
-    mime_multipart_parts = []
-    for name, (filename, blob, content_type) in parts.items():
-        multipart_part = RequestField(name=name, data=blob, filename=filename)
-        multipart_part.make_multipart(content_type=content_type)
-        mime_multipart_parts.append(multipart_part)
+    return ('--{0}\r\n'
+            'Content-Disposition: form-data; name="{1}"; filename="{2}"\r\n'
+            'Content-Type: {3}\r\n'
+            '\r\n').format(boundary, name, filename.replace('"', '%22'), content_type).encode('utf-8')
 
-    post_body, content_type = encode_multipart_formdata(mime_multipart_parts)
-    content_type = ''.join(('multipart/mixed',) + content_type.partition(';')[1:])
-    return post_body, content_type
 
+def _make_multipart_preamble(boundary, xml_part, name, filename):
+    
+    return b''.join((_multipart_part_header(boundary, 'request_payload', '', 'text/xml'),
+                     xml_part,
+                     b'\r\n',
+                     _multipart_part_header(boundary, name, filename, 'application/octet-stream')))
 
-def _check_status(server_response, success_code):
+
+def _make_multipart_epilogue(boundary):
     
-    if server_response.status_code != success_code:
-        parsed_response = ET.fromstring(server_response.text)
+    return '\r\n--{0}--\r\n'.format(boundary).encode('utf-8')
 
-      
-        error_element = parsed_response.find('t:error', namespaces=xmlns)
-        summary_element = parsed_response.find('.//t:summary', namespaces=xmlns)
-        detail_element = parsed_response.find('.//t:detail', namespaces=xmlns)
 
-        
-        code = error_element.get('code', 'unknown') if error_element is not None else 'unknown code'
-        summary = summary_element.text if summary_element is not None else 'unknown summary'
-        detail = detail_element.text if detail_element is not None else 'unknown detail'
-        error_message = '{0}: {1} - {2}'.format(code, summary, detail)
+class _MultipartBody(object):
+    
+    # Sized, so requests sends a Content-Length rather than falling back to
+    # chunked transfer-encoding as it does for a bare generator, and
+    # re-iterable, so a retried PUT resends the whole body.
+    def __init__(self, *parts):
+        self.parts = parts
+
+    def __len__(self):
+        return sum(len(part) for part in self.parts)
+
+    def __iter__(self):
+        return iter(self.parts)
+
+
+# A single boundary for the whole process, so the multipart framing below is
+# built once at import. Two uuid4s give 244 random bits, which will not turn up
+# in workbook data; scanning every chunk for it would cost a pass per chunk.
+_BOUNDARY = uuid.uuid4().hex + uuid.uuid4().hex
+_MULTIPART_CONTENT_TYPE = 'multipart/mixed; boundary={0}'.format(_BOUNDARY)
+_MULTIPART_EPILOGUE = _make_multipart_epilogue(_BOUNDARY)
+_CHUNK_PREAMBLE = _make_multipart_preamble(_BOUNDARY, b'', 'tableau_file', 'file')
+
+
+# quoteattr's escapes, for values that are kept as bytes.
+_XML_ATTR_ESCAPES = {ord('&'): b'&amp;', ord('<'): b'&lt;', ord('>'): b'&gt;', ord('"'): b'&quot;',
+                     ord('\n'): b'&#10;', ord('\r'): b'&#13;', ord('\t'): b'&#9;'}
+
+
+def _xml_escape_bytes(value):
+    
+    # Sized up front and filled in place, so growing the buffer never leaves a
+    # partial copy of the value behind in freed memory.
+    escaped = bytearray(sum(len(_XML_ATTR_ESCAPES.get(byte, b' ')) for byte in value))
+    position = 0
+    for byte in value:
+        replacement = _XML_ATTR_ESCAPES.get(byte)
+        if replacement is None:
+            escaped[position] = byte
+            position += 1
+        else:
+            escaped[position:position + len(replacement)] = replacement
+            position += len(replacement)
+    return escaped
+
+
+def _zero(buffer):
+    
+    buffer[:] = bytes(len(buffer))
+
+
+def _check_status(server_response, success_code):
+    
+    # Called after every chunk PUT, so the expected status returns before the
+    # response body is touched at all.
+    if server_response.status_code == success_code:
+        return
+
+    try:
+        parsed_response = ET.fromstring(server_response.content)
+    except ET.ParseError:
+        # Not a Tableau error document, e.g. a proxy's error page.
+        error_message = '{0}: {1}'.format(server_response.status_code, server_response.reason)
         raise ApiCallError(error_message)
-    return
+
+  
+    error_element = _find_error(parsed_response)
+    summary_element = _find_summary(parsed_response)
+    detail_element = _find_detail(parsed_response)
+
+    
+    code = error_element.get('code', 'unknown') if error_element is not None else 'unknown code'
+    summary = summary_element.text if summary_element is not None else 'unknown summary'
+    detail = detail_element.text if detail_element is not None else 'unknown detail'
+    error_message = '{0}: {1} - {2}'.format(code, summary, detail)
+    raise ApiCallError(error_message)
+
+
+def _advise_sequential(f):
+    
+    # The workbook is read front to back once, so ask the kernel for
+    # aggressive readahead; the default window is far smaller than a chunk.
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+
+def _read_chunks(f, slots, free_buffers):
+    
+    # Chunks are read into a pool of at most UPLOAD_READ_AHEAD_CHUNKS reusable
+    # buffers, so steady-state allocation is independent of the file size.
+    index = 0
+    while True:
+        slots.acquire()
+        buffer = free_buffers.pop() if free_buffers else bytearray(CHUNK_SIZE)
+        size = f.readinto(buffer)
+        if not size:
+            free_buffers.append(buffer)
+            slots.release()
+            return
+        yield index, buffer, memoryview(buffer)[:size]
+        index += 1
+
+
+def _content_md5(prefix_digest, *parts):
+    
+    # Content-MD5 covers the whole request body, multipart framing included,
+    # so the digest of the constant preamble is computed once and copied.
+    digest = prefix_digest.copy()
+    for part in parts:
+        digest.update(part)
+    return base64.b64encode(digest.digest()).decode('ascii')
+
+
+def _put_chunk(put_url, index, preamble, epilogue, content_type, data, checksum):
+    
+    print("\tPublishing chunk {0}...".format(index + 1))
+    payload = _MultipartBody(preamble, data, epilogue)
+    server_response = SESSION.put(put_url, data=payload,
+                                  headers={"content-type": content_type, "Content-MD5": checksum})
+    _check_status(server_response, 200)
 
 
 def sign_in(server, username, password, site=""):
@@ -83,68 +263,69 @@ def sign_in(server, username, password, site=""):
     url = server + "/api/{0}/auth/signin".format(VERSION)
 
   
-    xml_request = ET.Element('tsRequest')
-    credentials_element = ET.SubElement(xml_request, 'credentials', name=username, password=password)
-    ET.SubElement(credentials_element, 'site', contentUrl=site)
-    xml_request = ET.tostring(xml_request)
+    # The password is handled as a bytearray, and the request body is one too,
+    # so both can be wiped once the request has been sent. A str password is
+    # still accepted; it is converted here and the copy wiped as well.
+    if isinstance(password, str):
+        password = bytearray(password, 'utf-8')
+        converted_password = password
+    else:
+        converted_password = None
+    escaped_password = _xml_escape_bytes(password)
+    if converted_password is not None:
+        _zero(converted_password)
+    xml_request = bytearray().join((
+        '<tsRequest><credentials name={0} password="'.format(quoteattr(username)).encode('utf-8'),
+        escaped_password,
+        '"><site contentUrl={0}/></credentials></tsRequest>'.format(quoteattr(site)).encode('utf-8')))
+    _zero(escaped_password)
 
   
-    server_response = requests.post(url, data=xml_request)
+    try:
+        server_response = SESSION.post(url, data=xml_request)
+    finally:
+        _zero(xml_request)
     _check_status(server_response, 200)
 
-    server_response = _encode_for_display(server_response.text)
-
   
-    parsed_response = ET.fromstring(server_response)
+    parsed_response = ET.fromstring(server_response.content)
 
-    token = parsed_response.find('t:credentials', namespaces=xmlns).get('token')
-    site_id = parsed_response.find('.//t:site', namespaces=xmlns).get('id')
+    token = _find_credentials(parsed_response).get('token')
+    site_id = _find_site(parsed_response).get('id')
     return token, site_id
 
 
 def sign_out(server, auth_token):
     
     url = server + "/api/{0}/auth/signout".format(VERSION)
-    server_response = requests.post(url, headers={'x-tableau-auth': auth_token})
+    server_response = SESSION.post(url, headers={'x-tableau-auth': auth_token})
     _check_status(server_response, 204)
+    SESSION.headers.pop('x-tableau-auth', None)
     return
 
 
-def start_upload_session(server, auth_token, site_id):
+def start_upload_session(site_url):
     
-    url = server + "/api/{0}/sites/{1}/fileUploads".format(VERSION, site_id)
-    server_response = requests.post(url, headers={'x-tableau-auth': auth_token})
+    url = site_url + "/fileUploads"
+    server_response = SESSION.post(url)
     _check_status(server_response, 201)
-    xml_response = ET.fromstring(_encode_for_display(server_response.text))
-    return xml_response.find('t:fileUpload', namespaces=xmlns).get('uploadSessionId')
+    xml_response = ET.fromstring(server_response.content)
+    return _find_file_upload(xml_response).get('uploadSessionId')
 
 
-def get_default_project_id(server, auth_token, site_id):
+def get_default_project_id(site_url):
     
-    page_num, page_size = 1, 100  
-    url = server + "/api/{0}/sites/{1}/projects".format(VERSION, site_id)
-    paged_url = url + "?pageSize={0}&pageNumber={1}".format(page_size, page_num)
-    server_response = requests.get(paged_url, headers={'x-tableau-auth': auth_token})
-    _check_status(server_response, 200)
-    xml_response = ET.fromstring(_encode_for_display(server_response.text))
+    url = site_url + "/projects?pageSize=1&filter=name:eq:"
 
   
-    total_projects = int(xml_response.find('t:pagination', namespaces=xmlns).get('totalAvailable'))
-    max_page = int(math.ceil(total_projects / page_size))
-
-    projects = xml_response.findall('.//t:project', namespaces=xmlns)
-
-
-    for page in range(2, max_page + 1):
-        paged_url = url + "?pageSize={0}&pageNumber={1}".format(page_size, page)
-        server_response = requests.get(paged_url, headers={'x-tableau-auth': auth_token})
+    # Let the server filter by name instead of paging through every project.
+    # The filter is case sensitive, hence one lookup per spelling.
+    for name in ('Default', 'default'):
+        server_response = SESSION.get(url + name)
         _check_status(server_response, 200)
-        xml_response = ET.fromstring(_encode_for_display(server_response.text))
-        projects.extend(xml_response.findall('.//t:project', namespaces=xmlns))
-
-
-    for project in projects:
-        if project.get('name') == 'default' or project.get('name') == 'Default':
+        xml_response = ET.fromstring(server_response.content)
+        project = _find_project(xml_response)
+        if project is not None:
             return project.get('id')
     raise LookupError("Project named 'default' was not found on server")
 
@@ -163,9 +344,13 @@ def main():
     workbook_file = os.path.basename(workbook_file_path)
 
     print("\n*Publishing '{0}' to the default project as {1}*".format(workbook_file, username))
-    password = getpass.getpass("Password: ")
+    password = bytearray(getpass.getpass("Password: "), 'utf-8')
 
-    if not os.path.isfile(workbook_file_path):
+    try:
+        workbook_stat = os.stat(workbook_file_path)
+    except OSError:
+        workbook_stat = None
+    if workbook_stat is None or not stat.S_ISREG(workbook_stat.st_mode):
         error = "{0}: file not found".format(workbook_file_path)
         raise IOError(error)
 
@@ -177,66 +362,100 @@ def main():
         raise UserDefinedFieldError(error)
 
    
-    workbook_size = os.path.getsize(workbook_file_path)
-    chunked = workbook_size >= FILESIZE_LIMIT
+    workbook_size = workbook_stat.st_size
 
     ##### STEP 1: SIGN IN #####
     print("\n1. Signing in as " + username)
-    auth_token, site_id = sign_in(server, username, password)
+    try:
+        auth_token, site_id = sign_in(server, username, password)
+    finally:
+        _zero(password)
+    SESSION.headers.update({'x-tableau-auth': auth_token})
+    site_url = server + "/api/{0}/sites/{1}".format(VERSION, site_id)
 
     ##### STEP 2: OBTAIN DEFAULT PROJECT ID #####
     print("\n2. Finding the 'default' project to publish to")
-    project_id = get_default_project_id(server, auth_token, site_id)
+    project_id = get_default_project_id(site_url)
 
     ##### STEP 3: PUBLISH WORKBOOK ######
-    xml_request = ET.Element('tsRequest')
-    workbook_element = ET.SubElement(xml_request, 'workbook', name=workbook_filename)
-    ET.SubElement(workbook_element, 'project', id=project_id)
-    xml_request = ET.tostring(xml_request)
+    xml_request = ('<tsRequest>'
+                   '<workbook name={0}><project id={1}/></workbook>'
+                   '</tsRequest>').format(quoteattr(workbook_filename), quoteattr(project_id))
+    xml_request = xml_request.encode('utf-8')
 
-    if chunked:
-        print("\n3. Publishing '{0}' in {1}MB chunks (workbook over 64MB)".format(workbook_file, CHUNK_SIZE / 1024000))
-     
-        uploadID = start_upload_session(server, auth_token, site_id)
+    publish_url = site_url + "/workbooks?workbookType={0}&overwrite=true".format(file_extension)
 
-    
-        put_url = server + "/api/{0}/sites/{1}/fileUploads/{2}".format(VERSION, site_id, uploadID)
-
-       
-        with open(workbook_file_path, 'rb') as f:
-            while True:
-                data = f.read(CHUNK_SIZE)
-                if not data:
-                    break
-                payload, content_type = _make_multipart({'request_payload': ('', '', 'text/xml'),
-                                                         'tableau_file': ('file', data, 'application/octet-stream')})
-                print("\tPublishing a chunk...")
-                server_response = requests.put(put_url, data=payload,
-                                               headers={'x-tableau-auth': auth_token, "content-type": content_type})
-                _check_status(server_response, 200)
-
-        payload, content_type = _make_multipart({'request_payload': ('', xml_request, 'text/xml')})
-
-        publish_url = server + "/api/{0}/sites/{1}/workbooks".format(VERSION, site_id)
-        publish_url += "?uploadSessionId={0}".format(uploadID)
-        publish_url += "&workbookType={0}&overwrite=true".format(file_extension)
-    else:
-        print("\n3. Publishing '" + workbook_file + "' using the all-in-one method (workbook under 64MB)")
+    if workbook_size <= CHUNK_SIZE:
+        # A workbook that fits in one chunk goes up with the publish request
+        # itself, which saves creating an upload session and a PUT round trip.
+        print("\n3. Publishing '" + workbook_file + "' using the all-in-one method (workbook fits in one chunk)")
         
+        workbook_bytes = bytearray(workbook_size)
         with open(workbook_file_path, 'rb') as f:
-            workbook_bytes = f.read()
+            f.readinto(workbook_bytes)
 
         
-        parts = {'request_payload': ('', xml_request, 'text/xml'),
-                 'tableau_workbook': (workbook_file, workbook_bytes, 'application/octet-stream')}
-        payload, content_type = _make_multipart(parts)
-
-        publish_url = server + "/api/{0}/sites/{1}/workbooks".format(VERSION, site_id)
-        publish_url += "?workbookType={0}&overwrite=true".format(file_extension)
+        preamble = _make_multipart_preamble(_BOUNDARY, xml_request, 'tableau_workbook', workbook_file)
+        payload = _MultipartBody(preamble, workbook_bytes, _MULTIPART_EPILOGUE)
 
         print("\tUploading...")
-    server_response = requests.post(publish_url, data=payload,
-                                    headers={'x-tableau-auth': auth_token, 'content-type': content_type})
+    else:
+        print("\n3. Publishing '{0}' in {1:g}MB chunks".format(workbook_file, CHUNK_SIZE / (1024 * 1024.0)))
+     
+        uploadID = start_upload_session(site_url)
+
+    
+        put_url = site_url + "/fileUploads/{0}".format(uploadID)
+
+        # Tableau appends every chunk at the session's current offset, so the PUTs
+        # must reach the server in file order: a single worker sends them one by
+        # one while this thread reads the next chunks from disk.
+        chunk_preamble_md5 = hashlib.md5(_CHUNK_PREAMBLE)
+        slots = threading.Semaphore(UPLOAD_READ_AHEAD_CHUNKS)
+        free_buffers = []
+        failed = threading.Event()
+        futures = []
+        # Held while queueing a chunk and while cancelling after a failure, so
+        # no chunk can be queued behind a failed one once the sweep has run.
+        queue_lock = threading.Lock()
+
+        def _on_done(future, buffer):
+            try:
+                if not future.cancelled() and future.exception() is not None:
+                    # Chunks queued behind a failed one would only be retried in vain.
+                    with queue_lock:
+                        failed.set()
+                        for pending in futures:
+                            pending.cancel()
+            finally:
+                free_buffers.append(buffer)
+                slots.release()
+
+        with open(workbook_file_path, 'rb') as f, ThreadPoolExecutor(max_workers=1) as executor:
+            _advise_sequential(f)
+            for index, buffer, data in _read_chunks(f, slots, free_buffers):
+                # Hashed right after the read, while the chunk is still in cache.
+                checksum = _content_md5(chunk_preamble_md5, data, _MULTIPART_EPILOGUE)
+                with queue_lock:
+                    if failed.is_set():
+                        free_buffers.append(buffer)
+                        slots.release()
+                        break
+                    future = executor.submit(_put_chunk, put_url, index, _CHUNK_PREAMBLE, _MULTIPART_EPILOGUE,
+                                             _MULTIPART_CONTENT_TYPE, data, checksum)
+                    futures.append(future)
+                # Outside the lock: a future that is already done runs the
+                # callback right here, and a failure makes it take the lock.
+                future.add_done_callback(functools.partial(_on_done, buffer=buffer))
+
+        for future in futures:
+            future.result()
+
+        payload = _MultipartBody(_multipart_part_header(_BOUNDARY, 'request_payload', '', 'text/xml'),
+                                 xml_request, _MULTIPART_EPILOGUE)
+
+        publish_url += "&uploadSessionId={0}".format(uploadID)
+    server_response = SESSION.post(publish_url, data=payload, headers={'content-type': _MULTIPART_CONTENT_TYPE})
     _check_status(server_response, 201)
 
     ##### STEP 4: SIGN OUT #####